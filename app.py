@@ -1,11 +1,30 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Flask,
+    render_template,
+    request,
+    flash,
+    redirect,
+    session,
+    g,
+    abort,
+)
+from flask_caching import Cache, make_template_fragment_key
+from flask_session import Session
+import redis
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (
+    joinedload,
+    load_only,
+    make_transient_to_detached,
+    selectinload,
+)
+from sqlalchemy.pool import NullPool
 import dotenv
 from werkzeug.exceptions import Unauthorized
+from werkzeug.local import LocalProxy
 
 from forms import (
     UserAddForm,
@@ -20,6 +39,7 @@ from models import (
     User,
     Message,
     Like,
+    Follows,
     DEFAULT_HEADER,
     DEFAULT_IMAGE,
 )
@@ -36,10 +56,54 @@ app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["DATABASE_URL"].replace(
     "postgres://", "postgresql://"
 )
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+# If PGBOUNCER_URL is set, connect through PgBouncer instead. It pools the
+# real connections to Postgres, so SQLAlchemy shouldn't keep a pool of its
+# own on top: each checkout opens a (cheap) connection to PgBouncer.
+if "PGBOUNCER_URL" in os.environ:
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ[
+        "PGBOUNCER_URL"
+    ].replace("postgres://", "postgresql://")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"poolclass": NullPool}
+
+# Otherwise, size of each worker's DB connection pool can be set from environ;
+# async workers hold a connection per in-flight request, so they need more.
+elif "DB_POOL_SIZE" in os.environ:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ["DB_POOL_SIZE"]),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+    }
+
 app.config["SQLALCHEMY_ECHO"] = False
-app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
 app.config["SECRET_KEY"] = os.environ["SECRET_KEY"]
-toolbar = DebugToolbarExtension(app)
+
+# Cost of password hashes; tests turn this down, since hashing dominates them
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+# Keep sessions and caches in Redis if REDIS_URL is set in environ
+# (production); otherwise sessions stay in Flask's signed cookie and caching
+# is turned off, so development and tests always see fresh data.
+if "REDIS_URL" in os.environ:
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.Redis.from_url(os.environ["REDIS_URL"])
+    app.config["CACHE_TYPE"] = "RedisCache"
+    app.config["CACHE_REDIS_URL"] = os.environ["REDIS_URL"]
+    Session(app)
+else:
+    app.config["CACHE_TYPE"] = "NullCache"
+
+# Without this, in-process backends stop deleting at the first key of a
+# delete_many that isn't cached, leaving the rest stale
+app.config["CACHE_IGNORE_ERRORS"] = True
+
+# The debug toolbar is development-only; don't even import it otherwise
+if app.debug:
+    from flask_debugtoolbar import DebugToolbarExtension
+
+    app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
+    toolbar = DebugToolbarExtension(app)
+
+cache = Cache(app)
 
 connect_db(app)
 
@@ -48,27 +112,114 @@ connect_db(app)
 # User signup/login/logout
 
 
+# What's cached of the session's user; the rest loads when first used
+SESSION_USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+)
+
+
+@cache.memoize(60)
+def load_user(user_id):
+    """Load what most pages need of the session's user, as plain data.
+
+    That's the user's display columns and the ids of who they follow and
+    which messages they like, so templates can check follows and likes
+    without loading those rows. No related users or messages (or password
+    and email) are kept, so the cached copy can't go stale for anyone but
+    this user. The result is cached briefly, so call `forget_user` whenever
+    the user or those relationships change.
+    """
+
+    row = db.session.query(*SESSION_USER_COLUMNS).filter_by(id=user_id).first()
+    if row is None:
+        return None
+
+    return {
+        **row._asdict(),
+        "following_ids": {
+            followed_id
+            for (followed_id,) in db.session.query(
+                Follows.user_being_followed_id
+            ).filter_by(user_following_id=user_id)
+        },
+        "liked_message_ids": {
+            message_id
+            for (message_id,) in db.session.query(Like.message_id).filter_by(
+                user_id=user_id
+            )
+        },
+    }
+
+
+def restore_user(data):
+    """Rebuild the session's user from `load_user` data, in this DB session.
+
+    No SELECT is needed; columns that weren't cached, and relationships, load
+    from the DB on first use.
+    """
+
+    data = dict(data)
+    following_ids = data.pop("following_ids")
+    liked_message_ids = data.pop("liked_message_ids")
+
+    user = User(**data)
+    make_transient_to_detached(user)
+    user.following_ids = following_ids
+    user.liked_message_ids = liked_message_ids
+    db.session.add(user)
+
+    return user
+
+
+def forget_user(user_id):
+    """Drop cached copy of user, so next request reloads it from the DB."""
+
+    cache.delete_memoized(load_user, user_id)
+
+
+def forget_user_stats(*user_ids):
+    """Drop cached counts of messages, follows and likes on users' profiles."""
+
+    cache.delete_many(
+        *[
+            make_template_fragment_key("user_stats", vary_on=[str(user_id)])
+            for user_id in user_ids
+        ]
+    )
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        data = load_user(session[CURR_USER_KEY])
+        g.user = restore_user(data) if data else None
 
     else:
         g.user = None
 
 
-@app.before_request
-def add_form_to_g():
-    """Include CSRFProtectForm in Flask global.
+def get_csrf_form():
+    """Get CSRFProtectForm for this request, making it on first use.
 
     The form will have a hidden field of callback which is the path for this
     request. This allows for the form submition route to potentially redirect
     to where the form was submitted from.
     """
 
-    g.csrf_form = CSRFProtectForm(callback=request.path)
+    if "csrf_form" not in g:
+        g.csrf_form = CSRFProtectForm(callback=request.path)
+
+    return g.csrf_form
+
+
+# Templates use this as `csrf_form`; the form only gets made for requests that
+# actually render one
+app.jinja_env.globals["csrf_form"] = LocalProxy(get_csrf_form)
 
 
 def do_login(user):
@@ -84,6 +235,30 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def get_or_404(model, ident, options=()):
+    """Get instance of model by primary key, or abort with 404 if not found."""
+
+    # Session.get hands back an instance already in the session (like g.user)
+    # without querying, silently skipping the options; so when there are
+    # options, have it run the query and refresh that instance instead
+    instance = db.session.get(
+        model, ident, options=options, populate_existing=bool(options)
+    )
+    if instance is None:
+        abort(404)
+
+    return instance
+
+
+def row_exists(model, ident):
+    """Is there a row of model with this primary key?
+
+    Checks with a cheap EXISTS query, for when the row itself isn't needed.
+    """
+
+    return db.session.query(model.query.filter_by(id=ident).exists()).scalar()
+
+
 @app.route("/signup", methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -104,9 +279,7 @@ def signup():
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data
-                if form.image_url.data
-                else None,
+                image_url=form.image_url.data if form.image_url.data else None,
             )
             db.session.commit()
 
@@ -157,20 +330,41 @@ def logout():
 ##############################################################################
 # General user routes:
 
+# Columns shown on the user cards in lists of users; loading only these skips
+# fetching things like password hashes for every user in the list
+USER_CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
 
 @app.get("/users")
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, ignoring
+    case.
     """
 
     search = request.args.get("q")
 
+    query = User.query.options(load_only(*USER_CARD_COLUMNS))
+
     if not search:
-        users = User.query.all()
+        users = query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        # Escape wildcards, so they match literally in the search
+        pattern = (
+            search.replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_")
+        )
+        users = query.filter(
+            User.username.ilike(f"%{pattern}%", escape="\\")
+        ).all()
 
     return render_template("users/index.html", users=users)
 
@@ -179,7 +373,7 @@ def list_users():
 def show_user(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = get_or_404(User, user_id)
     return render_template("users/show.html", user=user)
 
 
@@ -191,7 +385,11 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = get_or_404(
+        User,
+        user_id,
+        options=[selectinload(User.following).load_only(*USER_CARD_COLUMNS)],
+    )
     return render_template("users/following.html", user=user)
 
 
@@ -203,7 +401,11 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = get_or_404(
+        User,
+        user_id,
+        options=[selectinload(User.followers).load_only(*USER_CARD_COLUMNS)],
+    )
     return render_template("users/followers.html", user=user)
 
 
@@ -215,7 +417,11 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = get_or_404(
+        User,
+        user_id,
+        options=[selectinload(User.liked_messages).joinedload(Message.user)],
+    )
     return render_template("users/likes.html", user=user)
 
 
@@ -231,9 +437,23 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if not row_exists(User, follow_id):
+        abort(404)
+
+    # Add the follow directly, rather than through g.user.following, so the
+    # user's whole following list doesn't get loaded just to add to it; the
+    # ids of who they follow were loaded with them, so skipping a repeat
+    # follow (a double-click or stale tab) is free
+    if follow_id not in g.user.following_ids:
+        db.session.add(
+            Follows(
+                user_being_followed_id=follow_id, user_following_id=g.user.id
+            )
+        )
+        db.session.commit()
+        forget_user(g.user.id)
+        forget_user_stats(g.user.id, follow_id)
+        forget_timeline(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -250,9 +470,18 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    deleted = Follows.query.filter(
+        Follows.user_being_followed_id == follow_id,
+        Follows.user_following_id == g.user.id,
+    ).delete()
+
+    if not deleted and not row_exists(User, follow_id):
+        abort(404)
+
     db.session.commit()
+    forget_user(g.user.id)
+    forget_user_stats(g.user.id, follow_id)
+    forget_timeline(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -264,7 +493,7 @@ def profile():
     if not g.user:
         raise Unauthorized("Not logged in.")
 
-    user = User.query.get(session[CURR_USER_KEY])
+    user = g.user
     form = UserEditForm(obj=user)
     if form.validate_on_submit():
         if not User.authenticate(user.username, form.password.data):
@@ -283,12 +512,11 @@ def profile():
         )
         user.bio = form.bio.data
         db.session.commit()
+        forget_user(user.id)
         return redirect(f"/users/{user.id}")
     else:
         form.image_url.data = (
-            ""
-            if form.image_url.data == DEFAULT_IMAGE
-            else form.image_url.data
+            "" if form.image_url.data == DEFAULT_IMAGE else form.image_url.data
         )
         form.header_image_url.data = (
             ""
@@ -312,8 +540,30 @@ def delete_user():
 
     do_logout()
 
+    # Deleting the user also deletes their follows, and their messages' likes,
+    # so the cached counts of everyone on the other side of those change too
+    follower_ids = {
+        follower_id
+        for (follower_id,) in db.session.query(
+            Follows.user_following_id
+        ).filter_by(user_being_followed_id=g.user.id)
+    }
+    liker_ids = {
+        liker_id
+        for (liker_id,) in db.session.query(Like.user_id)
+        .join(Message)
+        .filter(Message.user_id == g.user.id)
+    }
+
     db.session.delete(g.user)
     db.session.commit()
+    # Followers' and likers' cached copies hold the ids of who they follow
+    # and what they like, too
+    for user_id in {g.user.id} | follower_ids | liker_ids:
+        forget_user(user_id)
+    forget_user_stats(
+        g.user.id, *(g.user.following_ids | follower_ids | liker_ids)
+    )
 
     return redirect("/signup")
 
@@ -339,6 +589,8 @@ def messages_add():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
         db.session.commit()
+        forget_user_stats(g.user.id)
+        forget_timeline(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -349,7 +601,7 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = get_or_404(Message, message_id, options=[joinedload(Message.user)])
     return render_template("messages/show.html", message=msg)
 
 
@@ -365,13 +617,31 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    # The DB cascades the delete to the message's likes, so those who liked
+    # it need their cached copies and counts dropped too
+    liker_ids = [
+        liker_id
+        for (liker_id,) in db.session.query(Like.user_id).filter_by(
+            message_id=message_id
+        )
+    ]
 
-    if msg.user_id != g.user.id:
-        raise Unauthorized()
+    # Delete in one statement, only if it's the user's own message
+    deleted = Message.query.filter(
+        Message.id == message_id, Message.user_id == g.user.id
+    ).delete()
+
+    if not deleted:
+        if row_exists(Message, message_id):
+            raise Unauthorized()
+
+        abort(404)
 
-    db.session.delete(msg)
     db.session.commit()
+    for liker_id in liker_ids:
+        forget_user(liker_id)
+    forget_user_stats(g.user.id, *liker_ids)
+    forget_timeline(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -388,14 +658,23 @@ def like_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
+    author_id = (
+        db.session.query(Message.user_id).filter_by(id=message_id).scalar()
+    )
+    if author_id is None:
+        abort(404)
 
-    if message.user_id == g.user.id:
+    if author_id == g.user.id:
         flash("You can't like your own warbles!")
         return redirect(form.callback.data)
 
-    g.user.liked_messages.append(message)
-    db.session.commit()
+    # The ids of the user's likes were loaded with them, so this is free
+    if message_id not in g.user.liked_message_ids:
+        db.session.add(Like(user_id=g.user.id, message_id=message_id))
+        db.session.commit()
+        forget_user(g.user.id)
+        forget_user_stats(g.user.id)
+
     return redirect(form.callback.data)
 
 
@@ -411,10 +690,16 @@ def unlike_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    Like.query.filter(
+    deleted = Like.query.filter(
         Like.user_id == g.user.id, Like.message_id == message_id
     ).delete()
+
+    if not deleted and not row_exists(Message, message_id):
+        abort(404)
+
     db.session.commit()
+    forget_user(g.user.id)
+    forget_user_stats(g.user.id)
     return redirect(form.callback.data)
 
 
@@ -422,6 +707,40 @@ def unlike_message(message_id):
 # Homepage and error pages
 
 
+@cache.memoize(30)
+def get_timeline_message_ids(user_id):
+    """Get ids of the 100 most recent messages for user's timeline.
+
+    That's the user's own messages and those of the users they follow. The
+    ids are cached briefly, so call `forget_timeline` when the user posts or
+    deletes a message or changes who they follow.
+    """
+
+    followed_user_ids = db.session.query(
+        Follows.user_being_followed_id
+    ).filter(Follows.user_following_id == user_id)
+
+    messages = (
+        db.session.query(Message.id)
+        .filter(
+            or_(
+                Message.user_id == user_id,
+                Message.user_id.in_(followed_user_ids),
+            )
+        )
+        .order_by(Message.timestamp.desc())
+        .limit(100)
+    )
+
+    return [message_id for (message_id,) in messages]
+
+
+def forget_timeline(user_id):
+    """Drop cached timeline of user, so next visit rebuilds it."""
+
+    cache.delete_memoized(get_timeline_message_ids, user_id)
+
+
 @app.get("/")
 def homepage():
     """Show homepage:
@@ -433,29 +752,21 @@ def homepage():
     if g.user:
         messages = (
             Message.query.filter(
-                or_(
-                    Message.user_id == g.user.id,
-                    Message.user_id.in_(
-                        [following.id for following in g.user.following]
-                    ),
-                )
+                Message.id.in_(get_timeline_message_ids(g.user.id))
             )
+            .options(joinedload(Message.user))
             .order_by(Message.timestamp.desc())
-            .limit(100)
             .all()
         )
 
         return render_template("home.html", messages=messages)
 
     else:
-        form = LoginForm()
-        form.username.data = "demo"
-        form.password.data = "123123"
-        return render_template("home-anon.html", form=form)
+        return render_template("home-anon.html")
 
 
 ##############################################################################
-# Turn off all caching in Flask
+# Turn off caching of pages in Flask
 #   (useful for dev; in production, this kind of stuff is typically
 #   handled elsewhere)
 #
@@ -464,7 +775,13 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request but static files."""
+
+    # Pages carry per-session CSRF tokens and flashed messages, so they can
+    # never be shared or revalidated; static files keep the Last-Modified
+    # header send_file gives them, so browsers revalidate and get 304s.
+    if request.endpoint == "static":
+        return response
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
     response.cache_control.no_store = True
@@ -0,0 +1,38 @@
+"""Gunicorn settings for serving Warbler."""
+
+import os
+
+# Views spend most of their time waiting on Postgres, so each worker serves
+# several requests at once: while one waits on the DB, the others run.
+# Threads are the default; set GUNICORN_WORKER_CLASS=gevent to use green
+# threads instead, which are cheap enough to run hundreds per worker.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+if worker_class == "gevent":
+    worker_connections = int(
+        os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000)
+    )
+
+    # Every in-flight request holds a DB connection, so the app needs a
+    # much bigger pool than SQLAlchemy's default, unless it connects through
+    # PgBouncer (see app.py).
+    os.environ.setdefault("DB_POOL_SIZE", "50")
+    os.environ.setdefault("DB_MAX_OVERFLOW", "50")
+
+    # gevent patches the standard library in each worker, and that has to
+    # happen before the app gets imported, so the app can't be preloaded.
+    preload_app = False
+
+    def post_fork(server, worker):
+        """Make psycopg2 yield to other greenlets while it waits on Postgres."""
+
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+else:
+    threads = int(os.environ.get("GUNICORN_THREADS", 5))
+
+    # Import the app once in the master, so workers share that memory.
+    preload_app = True
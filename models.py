@@ -93,6 +93,17 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Trigram index, so username searches (substring matches) don't need to
+    # scan the whole table
+    __table_args__ = (
+        db.Index(
+            "ix_users_username_trgm",
+            username,
+            postgresql_using="gin",
+            postgresql_ops={"username": "gin_trgm_ops"},
+        ),
+    )
+
     messages = db.relationship("Message", order_by="Message.timestamp.desc()")
 
     followers = db.relationship(
@@ -116,6 +127,12 @@ class User(db.Model):
         order_by="desc(Message.timestamp)",
     )
 
+    # Ids of who the user follows and what they like, set when the session's
+    # user is restored from the cache (see app.load_user); when None, the
+    # checks below use the relationships instead
+    following_ids = None
+    liked_message_ids = None
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
@@ -130,6 +147,9 @@ class User(db.Model):
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
+        if self.following_ids is not None:
+            return other_user.id in self.following_ids
+
         found_user_list = [
             user for user in self.following if user == other_user
         ]
@@ -165,7 +185,12 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        # Only the columns login needs; the rest lazy-load if ever touched
+        user = (
+            cls.query.options(db.load_only(cls.id, cls.username, cls.password))
+            .filter_by(username=username)
+            .first()
+        )
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -175,6 +200,16 @@ class User(db.Model):
         return False
 
 
+# The trigram index on users needs the pg_trgm extension
+db.event.listen(
+    User.__table__,
+    "before_create",
+    db.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect="postgresql"
+    ),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -204,14 +239,18 @@ class Message(db.Model):
 
     user = db.relationship("User")
 
+    # Timelines show a user's most recent messages first
+    __table_args__ = (
+        db.Index("ix_messages_user_id_timestamp", user_id, timestamp.desc()),
+    )
+
     def is_liked_by(this, user):
         """Returns True if the message is liked by the user"""
 
-        return bool(
-            Like.query.filter(
-                Like.message_id == this.id, Like.user_id == user.id
-            ).one_or_none()
-        )
+        if user.liked_message_ids is not None:
+            return this.id in user.liked_message_ids
+
+        return this in user.liked_messages
 
 
 def connect_db(app):
@@ -222,3 +261,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
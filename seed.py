@@ -2,23 +2,36 @@
 
 from sqlalchemy.sql.expression import func
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User
 
 db.drop_all()
 db.create_all()
 
-with open("generator/users.csv") as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
 
-with open("generator/messages.csv") as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+def copy_from_csv(cursor, table, path):
+    """Bulk load rows of CSV file into table with Postgres' COPY.
 
-with open("generator/follows.csv") as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+    The header row of the file names the columns to fill.
+    """
 
-db.session.commit()
+    with open(path) as csv_file:
+        columns = csv_file.readline().strip()
+        cursor.copy_expert(
+            f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)",
+            csv_file,
+        )
+
+
+connection = db.engine.raw_connection()
+
+with connection.cursor() as cursor:
+    copy_from_csv(cursor, "users", "generator/users.csv")
+    copy_from_csv(cursor, "messages", "generator/messages.csv")
+    copy_from_csv(cursor, "follows", "generator/follows.csv")
+
+connection.commit()
+connection.close()
 
 
 user = User(
@@ -37,12 +37,11 @@ class UserModelTestCase(TestCase):
     """Test views for messages."""
 
     def setUp(self):
-        """Create test client, add sample data."""
+        """Add sample data."""
 
         User.query.delete()
         Follows.query.delete()
 
-        self.client = app.test_client()
         self.username = "user"
         self.email = "foo1@bar.com"
         user = User(
@@ -6,9 +6,10 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Like, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,10 +18,22 @@ from models import db, connect_db, Message, User
 
 os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
 
+# Use the cheapest bcrypt cost, so User.signup doesn't slow the tests down
+
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
+
 # Now we can import app
 
 from app import app, CURR_USER_KEY
 
+# These tests rely on Postgres (e.g. ON DELETE CASCADE); if another test
+# module already connected the app elsewhere, run this module on its own
+
+assert db.engine.dialect.name == "postgresql", (
+    f"test_message_views needs Postgres, but the app is already connected to "
+    f"{db.engine.url}; run it in a separate process"
+)
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -199,6 +212,34 @@ class MessageViewTestCase(TestCase):
             ).one_or_none()
             self.assertIsNone(message)
 
+    def test_messages_destroy_liked(self):
+        """Does deleting a message also delete its likes?"""
+
+        user2 = User(
+            email="user2@mail.com",
+            username="user2",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add(user2)
+        db.session.commit()
+        db.session.add(Like(user_id=user2.id, message_id=self.message_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post(f"/messages/{self.message_id}/delete")
+
+            # Should redirect
+            self.assertEqual(resp.status_code, 302)
+
+            # Message's likes should be gone along with it
+            like = Like.query.filter(
+                Like.message_id == self.message_id
+            ).one_or_none()
+            self.assertIsNone(like)
+
     def test_messages_destroy_logged_out(self):
         """Can we delete a message when logged out?"""
 
@@ -256,3 +297,162 @@ class MessageViewTestCase(TestCase):
 
             # Should have 404 response code
             self.assertEqual(resp.status_code, 404)
+
+    def test_like_message(self):
+        """Can we like another user's message?"""
+
+        user2 = User(
+            email="user2@mail.com",
+            username="user2",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add(user2)
+        db.session.commit()
+        user2_id = user2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            resp = c.post(
+                f"/messages/like/{self.message_id}", data={"callback": "/"}
+            )
+
+            # Should redirect back to where the form was
+            self.assertEqual(resp.status_code, 302)
+
+            # Should have created the like
+            like = Like.query.filter(
+                Like.user_id == user2_id, Like.message_id == self.message_id
+            ).one_or_none()
+            self.assertIsNotNone(like)
+
+    def test_like_own_message(self):
+        """Can we like our own message?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post(
+                f"/messages/like/{self.message_id}", data={"callback": "/"}
+            )
+
+            # Should redirect
+            self.assertEqual(resp.status_code, 302)
+
+            # Shouldn't have created a like
+            self.assertEqual(Like.query.count(), 0)
+
+    def test_like_message_invalid_id(self):
+        """Do we 404 when trying to like with invalid message_id?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/messages/like/420000", data={"callback": "/"})
+
+            # Should have 404 response code
+            self.assertEqual(resp.status_code, 404)
+
+    def test_unlike_message(self):
+        """Can we unlike a message we liked?"""
+
+        user2 = User(
+            email="user2@mail.com",
+            username="user2",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add(user2)
+        db.session.commit()
+        user2_id = user2.id
+
+        db.session.add(Like(user_id=user2_id, message_id=self.message_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            resp = c.post(
+                f"/messages/unlike/{self.message_id}", data={"callback": "/"}
+            )
+
+            # Should redirect back to where the form was
+            self.assertEqual(resp.status_code, 302)
+
+            # Should have removed the like
+            self.assertEqual(Like.query.count(), 0)
+
+    def test_unlike_message_invalid_id(self):
+        """Do we 404 when trying to unlike with invalid message_id?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/messages/unlike/420000", data={"callback": "/"})
+
+            # Should have 404 response code
+            self.assertEqual(resp.status_code, 404)
+
+    def test_homepage_timeline(self):
+        """Does the homepage show own and followed messages, newest first?"""
+
+        followed = User(
+            username="followed",
+            email="followed@test.com",
+            password="HASHED_PASSWORD",
+        )
+        stranger = User(
+            username="stranger",
+            email="stranger@test.com",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add_all([followed, stranger])
+        db.session.commit()
+
+        db.session.add_all(
+            [
+                Follows(
+                    user_being_followed_id=followed.id,
+                    user_following_id=self.user_id,
+                ),
+                Message(
+                    text="Followed older",
+                    user_id=followed.id,
+                    timestamp=datetime(2021, 1, 1),
+                ),
+                Message(
+                    text="Followed newer",
+                    user_id=followed.id,
+                    timestamp=datetime(2022, 1, 1),
+                ),
+                Message(
+                    text="Not followed",
+                    user_id=stranger.id,
+                    timestamp=datetime(2021, 6, 1),
+                ),
+            ]
+        )
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+
+            # Own message was just posted, so it's newest
+            self.assertLess(
+                html.index(self.text), html.index("Followed newer")
+            )
+            self.assertLess(
+                html.index("Followed newer"), html.index("Followed older")
+            )
+            # Users who aren't followed stay off the timeline
+            self.assertNotIn("Not followed", html)
@@ -5,11 +5,16 @@
 #    python -m unittest test_user_model.py
 
 import os
+import sys
 from unittest import TestCase
 
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+
 from models import (
     db,
     User,
+    Message,
     Follows,
     DEFAULT_IMAGE,
     DEFAULT_HEADER,
@@ -20,58 +25,171 @@ from models import (
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
+#
+# These tests only use plain SQL, so they run on an in-memory SQLite
+# database unless TEST_DATABASE_URL points them elsewhere, e.g.:
+#
+#    TEST_DATABASE_URL=postgresql:///warbler_test python -m unittest ...
+#
+# If another test module already imported the app, it's connected to that
+# module's database; leave DATABASE_URL alone so it isn't switched under
+# the other module's tests
 
-os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+if "app" not in sys.modules:
+    os.environ["DATABASE_URL"] = os.environ.get(
+        "TEST_DATABASE_URL", "sqlite:///:memory:"
+    )
+
+# Use the cheapest bcrypt cost, so User.signup doesn't slow the tests down
+
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
 
 # Now we can import app
 
 from app import app
 
+# Tests use one connection at a time, so on Postgres keep a single one for
+# the whole process, and don't wait for the WAL to be flushed on each
+# commit (losing the last few test transactions in a crash doesn't matter).
+# In-memory SQLite already gets one shared connection from Flask-SQLAlchemy.
+
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "poolclass": StaticPool,
+        "connect_args": {"options": "-c synchronous_commit=off"},
+    }
+
+# pysqlite starts transactions late and breaks SAVEPOINTs; have it leave
+# transactions alone and emit BEGIN ourselves
+# https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+
+if db.engine.dialect.name == "sqlite":
+
+    @db.event.listens_for(db.engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @db.event.listens_for(db.engine, "begin")
+    def do_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+
 # Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
+# once for all tests --- the sample data is added once for the class
+# and each test's changes are rolled back). One query for the existing
+# table names lets us skip create_all's per-table checks when the test
+# database is already set up
 
-db.create_all()
+if not set(db.metadata.tables) <= set(db.inspect(db.engine).get_table_names()):
+    db.create_all()
 
 
-class UserModelTestCase(TestCase):
-    """Test views for messages."""
+class UserFixtureTestCase(TestCase):
+    """Sample users shared by the user model tests, and their isolation."""
 
-    def setUp(self):
-        """Create test client, add sample data."""
+    password = "FeL7f23#1"
+
+    @classmethod
+    def hash_password(cls):
+        """Stored password of the sample users; tests here never check it."""
+
+        return "HASHED_PASSWORD"
+
+    @classmethod
+    def setUpClass(cls):
+        """Add sample data once; each test runs in a rolled-back SAVEPOINT."""
 
         User.query.delete()
         Follows.query.delete()
 
-        self.client = app.test_client()
-        self.password = "FeL7f23#1"
-        self.username1 = "user1"
-        self.email1 = "foo1@bar.com"
-        self.username2 = "user2"
-        self.email2 = "foo2@bar.com"
-        user1 = User(
-            email=self.email1,
-            username=self.username1,
-            password=bcrypt.generate_password_hash(self.password).decode(
-                "UTF-8"
-            ),
-        )
-        user2 = User(
-            email=self.email2,
-            username=self.username2,
-            password=bcrypt.generate_password_hash(self.password).decode(
-                "UTF-8"
-            ),
+        cls.username1 = "user1"
+        cls.email1 = "foo1@bar.com"
+        cls.username2 = "user2"
+        cls.email2 = "foo2@bar.com"
+        # Both users have the same password, so they can share one hash.
+        # Insert both rows in one executemany, skipping the unit of work
+        password_hash = cls.hash_password()
+        db.session.execute(
+            db.insert(User),
+            [
+                dict(
+                    email=cls.email1,
+                    username=cls.username1,
+                    password=password_hash,
+                ),
+                dict(
+                    email=cls.email2,
+                    username=cls.username2,
+                    password=password_hash,
+                ),
+            ],
         )
-        db.session.add_all([user1, user2])
+        cls.user1_id, cls.user2_id = db.session.execute(
+            db.select(User.id)
+            .filter(User.username.in_([cls.username1, cls.username2]))
+            .order_by(User.username)
+        ).scalars()
         db.session.commit()
-        self.user1_id = user1.id
-        self.user2_id = user2.id
+        db.session.remove()
+
+        # All tests share one connection and one outer transaction
+        cls.connection = db.engine.connect()
+        cls.transaction = cls.connection.begin()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Close the shared transaction and connection."""
+
+        cls.transaction.rollback()
+        cls.connection.close()
+
+    def setUp(self):
+        """Start a SAVEPOINT to roll back."""
+
+        # Each test gets a SAVEPOINT on the shared connection and a fresh
+        # session bound to it; the test's commits only release the
+        # session's own SAVEPOINT, which is then reopened
+        self.savepoint = self.connection.begin_nested()
+        app_session = db.session
+        db.session = db.create_scoped_session(
+            options={"bind": self.connection, "binds": {}}
+        )
+
+        # Registered right away, so the app's session is put back even if
+        # the rest of setUp fails and tearDown never runs
+        self.addCleanup(self.restore_session, app_session)
+
+        db.session.begin_nested()
+
+        @db.event.listens_for(db.session(), "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+    def restore_session(self, app_session):
+        """Throw away everything the test did; put back the app's session."""
 
-    def tearDown(self):
-        """Clean up fouled transactions."""
+        try:
+            # Closing the session already rolls back to the test's SAVEPOINT
+            db.session.remove()
+            if self.savepoint.is_active:
+                self.savepoint.rollback()
+        finally:
+            db.session = app_session
+
+    def get_users(self):
+        """Load both sample users with one query."""
+
+        return (
+            User.query.filter(User.id.in_([self.user1_id, self.user2_id]))
+            .order_by(User.id)
+            .all()
+        )
 
-        db.session.rollback()
+
+class UserModelTestCase(UserFixtureTestCase):
+    """Test the user model."""
 
     def test_user_model(self):
         """Does basic model work?"""
@@ -86,8 +204,11 @@ class UserModelTestCase(TestCase):
         db.session.commit()
 
         # User should have no messages & no followers
-        self.assertEqual(len(user.messages), 0)
-        self.assertEqual(len(user.followers), 0)
+        # (count in the database, rather than loading the related rows)
+        self.assertEqual(Message.query.filter_by(user_id=user.id).count(), 0)
+        self.assertEqual(
+            Follows.query.filter_by(user_being_followed_id=user.id).count(), 0
+        )
 
         # User should have default images
         self.assertEqual(user.image_url, DEFAULT_IMAGE)
@@ -99,7 +220,7 @@ class UserModelTestCase(TestCase):
     def test_dunder_repr(self):
         """Are users correctly represented?"""
 
-        user1 = User.query.get(self.user1_id)
+        user1 = db.session.get(User, self.user1_id)
 
         self.assertIn(str(self.user1_id), user1.__repr__())
         self.assertIn(self.username1, user1.__repr__())
@@ -108,8 +229,7 @@ class UserModelTestCase(TestCase):
     def test_is_following(self):
         """Does is_following correctly return if user is following?"""
 
-        user1 = User.query.get(self.user1_id)
-        user2 = User.query.get(self.user2_id)
+        user1, user2 = self.get_users()
 
         # User1 shouldn't be following user2
         self.assertFalse(user1.is_following(user2))
@@ -124,8 +244,7 @@ class UserModelTestCase(TestCase):
     def test_is_followed_by(self):
         """Does is_followed_by correctly return if user is followed by?"""
 
-        user1 = User.query.get(self.user1_id)
-        user2 = User.query.get(self.user2_id)
+        user1, user2 = self.get_users()
 
         # User1 shouldn't be followed by user2
         self.assertFalse(user1.is_followed_by(user2))
@@ -163,82 +282,63 @@ class UserModelTestCase(TestCase):
     def test_signup_fails_uniqueness(self):
         """Does User.signup fail when given non-unique values for unique fields?"""
 
-        # Does signing up a user with a non-unique username fail?
-        User.signup(
-            self.username1,
-            "unique@mail.com",
-            "123123",
-            "static/images/default-pic.png",
-        )
-        try:
-            db.session.commit()
-        except:
-            # Correct behavior
-            db.session.rollback()
-        else:
-            self.fail("Exception not raised.")
-
-        # Does signing up a user with a non-unique email fail?
-        User.signup(
-            "unique_username",
-            self.email1,
-            "123123",
-            "static/images/default-pic.png",
-        )
-        try:
-            db.session.commit()
-        except:
-            # Correct behavior
-            db.session.rollback()
-        else:
-            self.fail("Exception not raised.")
+        cases = [
+            ("non-unique username", self.username1, "unique@mail.com"),
+            ("non-unique email", "unique_username", self.email1),
+        ]
+
+        for name, username, email in cases:
+            with self.subTest(name):
+                User.signup(
+                    username,
+                    email,
+                    "123123",
+                    "static/images/default-pic.png",
+                )
+                # The constraint is checked on flush; no need to commit
+                with self.assertRaises(IntegrityError):
+                    db.session.flush()
+                db.session.rollback()
 
     def test_signup_fails_nullable(self):
         """Does User.signup fail when given None for non-nullable fields?"""
 
-        # Does signing up a user with username of None fail?
-        User.signup(
-            None,
-            "user3@foo.bar",
-            "123123",
-            "static/images/default-pic.png",
-        )
-        try:
-            db.session.commit()
-        except:
-            # Correct behavior
-            db.session.rollback()
-        else:
-            self.fail("Exception not raised when username is null.")
-
-        # Does signing up a user with email of None fail?
-        User.signup(
-            "unique_username",
-            None,
-            "123123",
-            "static/images/default-pic.png",
-        )
-        try:
-            db.session.commit()
-        except:
-            # Correct behavior
-            db.session.rollback()
-        else:
-            self.fail("Exception not raised when email is null.")
-
-        # Does signing up a user with password of None fail?
-        try:
+        cases = [
+            ("username is null", None, "user3@foo.bar"),
+            ("email is null", "unique_username", None),
+        ]
+
+        for name, username, email in cases:
+            with self.subTest(name):
+                User.signup(
+                    username,
+                    email,
+                    "123123",
+                    "static/images/default-pic.png",
+                )
+                with self.assertRaises(IntegrityError):
+                    db.session.flush()
+                db.session.rollback()
+
+        # Does signing up a user with password of None fail? (bcrypt
+        # refuses to hash it, before anything reaches the database)
+        with self.assertRaises(ValueError):
             User.signup(
                 "unique_username",
                 "user3@foo.bar",
                 None,
                 "static/images/default-pic.png",
             )
-        except:
-            # Correct behavior
-            pass
-        else:
-            self.fail("Exception not raised when password is null.")
+
+
+class UserAuthenticateTestCase(UserFixtureTestCase):
+    """Test User.authenticate against real password hashes."""
+
+    @classmethod
+    def hash_password(cls):
+        """Hash the sample password with bcrypt's cheapest cost."""
+
+        return bcrypt.generate_password_hash(cls.password, 4).decode("ascii")
 
     def test_authenticate(self):
         """Does User.authenticate return user when valid username, password?"""
@@ -0,0 +1,264 @@
+"""User View tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_user_views.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, Message, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ["DATABASE_URL"] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# These tests rely on Postgres (e.g. ON DELETE CASCADE); if another test
+# module already connected the app elsewhere, run this module on its own
+
+assert db.engine.dialect.name == "postgresql", (
+    f"test_user_views needs Postgres, but the app is already connected to "
+    f"{db.engine.url}; run it in a separate process"
+)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config["WTF_CSRF_ENABLED"] = False
+
+
+class UserViewTestCase(TestCase):
+    """Test views for users."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        user1 = User(
+            email="user1@test.com",
+            username="user1",
+            password="HASHED_PASSWORD",
+        )
+        user2 = User(
+            email="user2@test.com",
+            username="user2",
+            password="HASHED_PASSWORD",
+        )
+        db.session.add_all([user1, user2])
+        db.session.commit()
+        self.user1_id = user1.id
+        self.user2_id = user2.id
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def is_following(self, user_id, followed_user_id):
+        """Is there a follow from user_id to followed_user_id in the DB?"""
+
+        return (
+            Follows.query.filter_by(
+                user_following_id=user_id,
+                user_being_followed_id=followed_user_id,
+            ).one_or_none()
+            is not None
+        )
+
+    def test_list_users_search(self):
+        """Does searching users match part of the username, ignoring case?"""
+
+        with self.client as c:
+            resp = c.get("/users?q=USER1")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@user1", html)
+            self.assertNotIn("@user2", html)
+
+    def test_list_users_search_wildcard(self):
+        """Are LIKE wildcards in the search matched literally?"""
+
+        with self.client as c:
+            resp = c.get("/users?q=%25")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_add_follow(self):
+        """Can we follow another user?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = c.post(f"/users/follow/{self.user2_id}")
+
+            # Should redirect to the following page
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn(f"/users/{self.user1_id}/following", resp.location)
+
+            # Should have created the follow
+            self.assertTrue(self.is_following(self.user1_id, self.user2_id))
+
+    def test_add_follow_logged_out(self):
+        """Can we follow a user when logged out?"""
+
+        with self.client as c:
+            resp = c.post(f"/users/follow/{self.user2_id}")
+
+            # Should redirect
+            self.assertEqual(resp.status_code, 302)
+
+            # Shouldn't have created any follow
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_add_follow_invalid_id(self):
+        """Do we 404 when trying to follow a user that doesn't exist?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = c.post("/users/follow/420000")
+
+            # Should have 404 response code
+            self.assertEqual(resp.status_code, 404)
+
+    def test_add_follow_twice(self):
+        """Does following someone we already follow just redirect again?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post(f"/users/follow/{self.user2_id}")
+            resp = c.post(f"/users/follow/{self.user2_id}")
+
+            # Should redirect, as the first follow did
+            self.assertEqual(resp.status_code, 302)
+
+            # Should still have just the one follow
+            self.assertEqual(
+                Follows.query.filter_by(
+                    user_following_id=self.user1_id,
+                    user_being_followed_id=self.user2_id,
+                ).count(),
+                1,
+            )
+
+    def test_stop_following(self):
+        """Can we stop following a user?"""
+
+        db.session.add(
+            Follows(
+                user_being_followed_id=self.user2_id,
+                user_following_id=self.user1_id,
+            )
+        )
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = c.post(f"/users/stop-following/{self.user2_id}")
+
+            # Should redirect
+            self.assertEqual(resp.status_code, 302)
+
+            # Should have removed the follow
+            self.assertFalse(self.is_following(self.user1_id, self.user2_id))
+
+    def test_stop_following_invalid_id(self):
+        """Do we 404 when trying to stop following a user that doesn't exist?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = c.post("/users/stop-following/420000")
+
+            # Should have 404 response code
+            self.assertEqual(resp.status_code, 404)
+
+    def test_pages_dont_load_current_user_relationships(self):
+        """Do pages check follows and likes without loading them for g.user?
+
+        The session's user comes with the ids of who they follow and like;
+        fail if a page lazy-loads those relationships anyway, as raiseload
+        would.
+        """
+
+        message = Message(text="hello", user_id=self.user2_id)
+        db.session.add_all(
+            [
+                message,
+                Follows(
+                    user_being_followed_id=self.user2_id,
+                    user_following_id=self.user1_id,
+                ),
+            ]
+        )
+        db.session.commit()
+        db.session.add(Like(user_id=self.user1_id, message_id=message.id))
+        db.session.commit()
+        message_id = message.id
+
+        lazy_loads = []
+
+        def record_lazy_load(orm_execute_state):
+            state = orm_execute_state.lazy_loaded_from
+            if (
+                state is not None
+                and state.class_ is User
+                and state.identity == (self.user1_id,)
+            ):
+                lazy_loads.append(orm_execute_state.loader_strategy_path.prop)
+
+        db.event.listen(db.session, "do_orm_execute", record_lazy_load)
+        self.addCleanup(
+            db.event.remove, db.session, "do_orm_execute", record_lazy_load
+        )
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            for url in [
+                "/users",
+                f"/users/{self.user1_id}",
+                f"/users/{self.user1_id}/following",
+                f"/users/{self.user1_id}/followers",
+                f"/users/{self.user1_id}/likes",
+                f"/users/{self.user2_id}",
+                f"/users/{self.user2_id}/following",
+                f"/users/{self.user2_id}/followers",
+                f"/users/{self.user2_id}/likes",
+                f"/messages/{message_id}",
+            ]:
+                with self.subTest(url):
+                    lazy_loads.clear()
+                    resp = c.get(url)
+
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertNotIn(User.following.property, lazy_loads)
+                    self.assertNotIn(User.liked_messages.property, lazy_loads)